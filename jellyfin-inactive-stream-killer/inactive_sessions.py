@@ -1,14 +1,29 @@
 #!/usr/bin/env python3
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
 import time
 import logging
+import mmap
 import argparse
 import sys
 import os
-import pickle
+import signal
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 import re
+from operator import itemgetter
+
+# Prefer orjson for encoding and decoding JSON when it's installed
+try:
+    from orjson import loads as json_loads, dumps as json_dumps
+except ImportError:
+    def json_loads(data):
+        return json.loads(bytes(data))
+
+    def json_dumps(obj):
+        return json.dumps(obj).encode()
 
 # Set up logging
 logging.basicConfig(
@@ -20,6 +35,22 @@ logging.basicConfig(
 )
 logger = logging.getLogger('jellyfin-session-terminator')
 
+# (connect, read) timeout in seconds for Jellyfin API calls so a hung server can't stall the script.
+# Read timeouts aren't retried, but connection failures and 502/503/504 responses are retried up to
+# twice by the session's Retry, so one call can take up to about 3 x (3.05 + 10)s plus ~1s of backoff.
+HTTP_TIMEOUT = (3.05, 10)
+
+# Fields every usable session has; fetched in one C-level call in the scan loop
+SESSION_CORE_FIELDS = itemgetter('Id', 'UserId', 'PlayState')
+
+def parse_jellyfin_time(value):
+    """Convert a Jellyfin timestamp (e.g. 2024-05-01T18:22:13.1234567Z) to epoch seconds, or None"""
+    try:
+        parsed = datetime.strptime(value[:19], '%Y-%m-%dT%H:%M:%S')
+    except (TypeError, ValueError):
+        return None
+    return int(parsed.replace(tzinfo=timezone.utc).timestamp())
+
 class JellyfinSessionTerminator:
     def __init__(self, server_url, api_key, inactivity_timeout_minutes=30, dry_run=False, state_file=None):
         """
@@ -33,6 +64,7 @@ class JellyfinSessionTerminator:
             state_file (str): Path to file for storing session state between runs
         """
         self.server_url = server_url.rstrip('/')
+        self._sessions_url = f"{self.server_url}/Sessions"
         self.api_key = api_key
         self.inactivity_timeout = inactivity_timeout_minutes * 60  # Convert to seconds
         self.dry_run = dry_run
@@ -41,126 +73,244 @@ class JellyfinSessionTerminator:
             'Content-Type': 'application/json'
         }
         
+        # Persistent HTTP session so every call reuses one pooled keep-alive connection
+        self.http = requests.Session()
+        self.http.headers.update(self.headers)
+        adapter = HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=16,
+            # read=False re-raises read timeouts immediately so they surface as requests' ReadTimeout
+            # rather than a ConnectionError wrapping MaxRetryError
+            max_retries=Retry(total=2, read=False, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+        )
+        self.http.mount('http://', adapter)
+        self.http.mount('https://', adapter)
+        
+        # Worker pool for sending termination commands concurrently
+        self._pool = ThreadPoolExecutor(max_workers=4)
+        # Separate pool for the advisory DisplayMessage calls so they never queue behind Stop commands
+        self._notify_pool = ThreadPoolExecutor(max_workers=8)
+        
         # File to store session state between runs
         self.state_file = state_file or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'jellyfin_sessions.state')
         self.session_state = self._load_session_state()
+        self._state_dirty = False  # Set whenever session_state changes so unchanged state isn't rewritten
         
     def _load_session_state(self):
         """Load saved session state from file"""
         try:
             if os.path.exists(self.state_file):
-                with open(self.state_file, 'rb') as f:
-                    return pickle.load(f)
+                # Parse straight from a memory map of the file instead of reading it into a buffer first
+                with open(self.state_file, 'rb') as f, \
+                        mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, \
+                        memoryview(mm) as view:
+                    raw = json_loads(view)
+                return {sid: int(ts) for sid, ts in raw.items()}
             return {}
         except Exception as e:
-            logger.warning(f"Error loading session state: {e}")
+            logger.warning("Error loading session state: %s", e)
             return {}
     
     def _save_session_state(self):
         """Save session state to file"""
         try:
-            with open(self.state_file, 'wb') as f:
-                pickle.dump(self.session_state, f)
+            # Write to a temporary file and swap it in so a crash never leaves a torn state file
+            tmp_file = self.state_file + '.tmp'
+            with open(tmp_file, 'wb') as f:
+                f.write(json_dumps(self.session_state))
+            os.replace(tmp_file, self.state_file)
+            self._state_dirty = False
         except Exception as e:
-            logger.warning(f"Error saving session state: {e}")
+            logger.warning("Error saving session state: %s", e)
+            
+    def flush(self):
+        """Save session state if it has changed since it was last written"""
+        if self._state_dirty:
+            self._save_session_state()
+            
+    def close(self):
+        """Shut down the worker pool and close the underlying HTTP session"""
+        self._notify_pool.shutdown(wait=True)
+        self._pool.shutdown(wait=True)
+        self.http.close()
             
     def get_active_sessions(self):
-        """Get all active Jellyfin sessions"""
+        """Get all active Jellyfin sessions, or None if they couldn't be fetched"""
         try:
-            response = requests.get(
-                f"{self.server_url}/Sessions",
-                headers=self.headers
+            # activeWithinSeconds makes the server drop sessions whose LastActivityDate is older than
+            # this window. A session that falls out of the window can no longer be seen or stopped,
+            # so paused sessions are tracked from their LastActivityDate (see process_sessions),
+            # which makes them reach the inactivity timeout well before they drop out.
+            response = self.http.get(
+                self._sessions_url,
+                params={'activeWithinSeconds': self.inactivity_timeout * 2 + 600},
+                timeout=HTTP_TIMEOUT
             )
             response.raise_for_status()
-            return response.json()
+            return json_loads(response.content)
+        except requests.exceptions.Timeout as e:
+            logger.error("Timed out fetching sessions: %s", e)
+            return None
         except requests.exceptions.RequestException as e:
-            logger.error(f"Error fetching sessions: {e}")
-            return []
-    
-    def terminate_session(self, session_id):
-        """Terminate a specific session by ID"""
-        if self.dry_run:
-            logger.info(f"DRY RUN: Would terminate session {session_id}")
-            return True
+            logger.error("Error fetching sessions: %s", e)
+            return None
+        except ValueError as e:
+            # orjson/json decode errors, e.g. a proxy login or error page returned with a 200
+            logger.error("Error decoding sessions response: %s", e)
+            return None
     
+    def _notify_session(self, session_id):
+        """Show the termination message on a session's client"""
         try:
-            # Optional: Notify user
-            requests.post(
-                f"{self.server_url}/Sessions/{session_id}/Command/DisplayMessage",
-                headers=self.headers,
+            self.http.post(
+                self._sessions_url + "/" + session_id + "/Command/DisplayMessage",
                 json={
                     "Header": "Session Terminated",
                     "Text": "Your session was terminated due to inactivity"
-                }
+                },
+                timeout=2
             )
+        except requests.exceptions.RequestException as e:
+            logger.debug("Error sending message to session %s: %s", session_id, e)
+    
+    def terminate_session(self, session_id, notify=True):
+        """Terminate a specific session by ID, optionally notifying its client first"""
+        if self.dry_run:
+            logger.info("DRY RUN: Would terminate session %s", session_id)
+            return True
+    
+        try:
+            # Optional: Notify user. The message is advisory, so it is sent in the
+            # background and its round trip overlaps with the Stop request below.
+            if notify:
+                self._notify_pool.submit(self._notify_session, session_id)
     
             # Forcefully terminate session
-            response = requests.post(
-                f"{self.server_url}/Sessions/{session_id}/Playing/Stop",
-                headers=self.headers
+            response = self.http.post(
+                self._sessions_url + "/" + session_id + "/Playing/Stop",
+                timeout=HTTP_TIMEOUT
             )
             response.raise_for_status()
     
-            logger.info(f"Sent Stop command to session {session_id}")
+            logger.info("Sent Stop command to session %s", session_id)
             return True
+        except requests.exceptions.Timeout as e:
+            logger.error("Timed out sending Stop command to session %s: %s", session_id, e)
+            return False
         except requests.exceptions.RequestException as e:
-            logger.error(f"Error sending Stop command to session {session_id}: {e}")
+            logger.error("Error sending Stop command to session %s: %s", session_id, e)
             return False
     
+    def terminate_sessions(self, session_ids):
+        """Terminate several sessions concurrently, returning the IDs that were stopped"""
+        if len(session_ids) <= 1:
+            return [sid for sid in session_ids if self.terminate_session(sid)]
+        
+        # Queue every notification before any Stop so each message goes out ahead of its Stop
+        # instead of waiting for a free worker behind the other terminations
+        if not self.dry_run:
+            for session_id in session_ids:
+                self._notify_pool.submit(self._notify_session, session_id)
+        
+        results = self._pool.map(lambda sid: self.terminate_session(sid, notify=False), session_ids)
+        return [sid for sid, ok in zip(session_ids, results) if ok]
+    
     def process_sessions(self):
         """Process all sessions and terminate inactive ones"""
         sessions = self.get_active_sessions()
-        now = datetime.now(timezone.utc)  # Use UTC time for consistency
-        terminated_count = 0
+        if sessions is None:
+            # Leave tracked state alone rather than treating a failed fetch as "no sessions"
+            return 0
+
+        # Nothing tracked and nothing paused: there is nothing to start, clear or terminate
+        if not self.session_state and not any((session.get('PlayState') or {}).get('IsPaused') for session in sessions):
+            return 0
+
+        now = int(time.time())  # Epoch seconds, timezone-independent
+        # Sessions are classified in one pass, then state changes and terminations are applied in bulk
+        to_start, to_clear, to_kill = [], [], []
 
         # Removed the current time log
 
+        # Bind frequently used attributes and methods to locals for the loop below
+        session_state = self.session_state
+        state_get = session_state.get
+        state_pop = session_state.pop
+        start, clear, kill = to_start.append, to_clear.append, to_kill.append
+        inactivity_timeout = self.inactivity_timeout
+        log_info = logger.info
+
+        seen = {session['Id'] for session in sessions if session.get('Id')}
+
         for session in sessions:
-            session_id = session.get('Id')
-            username = session.get('UserName', 'Unknown User')
-            client_name = session.get('Client', 'Unknown client')
-            device_name = session.get('DeviceName', 'Unknown device')
-            media_info = session.get('NowPlayingItem', {}).get('Name', 'Unknown media')
-            playstate = session.get('PlayState', {})
+            # Check the gating fields first; most sessions are skipped here
+            try:
+                session_id, user_id, playstate = SESSION_CORE_FIELDS(session)
+            except KeyError:
+                continue
+            if not playstate or not user_id:
+                continue
 
-            if not session.get('UserId') or not playstate:
+            if not playstate.get('IsPaused', False):
+                # Not paused; clear tracking if it was paused before
+                if session_id in session_state:
+                    username = session.get('UserName', 'Unknown User')
+                    device_name = session.get('DeviceName', 'Unknown device')
+                    log_info("Session for %s on %s resumed or stopped; removing from tracking", username, device_name)
+                    clear(session_id)
                 continue
 
-            is_paused = playstate.get('IsPaused', False)
+            username = session.get('UserName', 'Unknown User')
+            device_name = session.get('DeviceName', 'Unknown device')
 
-            if is_paused:
-                paused_since = self.session_state.get(session_id)
-                if not paused_since:
-                    # First time we see it paused, record timestamp
-                    self.session_state[session_id] = now
-                    logger.info(f"Session for {username} on {device_name} is now paused (started tracking)")
+            paused_since = state_get(session_id)
+            if not paused_since:
+                # First time we see it paused, record when it was last active. It may have been
+                # paused long before we first saw it (fresh start or reset state file).
+                last_activity = parse_jellyfin_time(session.get('LastActivityDate'))
+                paused_since = min(now, last_activity) if last_activity else now
+                start((session_id, paused_since))
+                log_info("Session for %s on %s is now paused (started tracking)", username, device_name)
+                if now - paused_since < inactivity_timeout:
                     continue
 
-                inactive_time = (now - paused_since).total_seconds()
-
-                if inactive_time >= self.inactivity_timeout:
-                    logger.info(f"Found inactive paused session for user {username} on {device_name} ({client_name})")
-                    logger.info(f"Media: {media_info}, Inactive for: {timedelta(seconds=inactive_time)}")
-                    if self.terminate_session(session_id):
-                        terminated_count += 1
-                        # Remove from state
-                        self.session_state.pop(session_id, None)
-                else:
-                    remaining = self.inactivity_timeout - inactive_time
-                    logger.info(
-                        f"Session for {username} on {device_name} is paused "
-                        f"({timedelta(seconds=inactive_time)}), "
-                        f"will be terminated in {timedelta(seconds=remaining)}"
-                    )
+            inactive_time = now - paused_since
+
+            if inactive_time >= inactivity_timeout:
+                client_name = session.get('Client', 'Unknown client')
+                media_info = session.get('NowPlayingItem', {}).get('Name', 'Unknown media')
+                log_info("Found inactive paused session for user %s on %s (%s)", username, device_name, client_name)
+                log_info("Media: %s, Inactive for: %s", media_info, timedelta(seconds=inactive_time))
+                kill(session_id)
             else:
-                # Not paused; clear tracking if it was paused before
-                if session_id in self.session_state:
-                    logger.info(f"Session for {username} on {device_name} resumed or stopped; removing from tracking")
-                    self.session_state.pop(session_id, None)
+                # Guarded because this runs for every paused session and builds two timedeltas
+                if logger.isEnabledFor(logging.INFO):
+                    remaining = inactivity_timeout - inactive_time
+                    log_info(
+                        "Session for %s on %s is paused (%s), will be terminated in %s",
+                        username, device_name,
+                        timedelta(seconds=inactive_time), timedelta(seconds=remaining)
+                    )
 
-        # Save updated session state
-        self._save_session_state()
-        return terminated_count
+        # Also drop tracked sessions that no longer exist on the server (e.g. clients that disconnected while paused)
+        to_clear.extend(set(session_state) - seen)
+
+        if to_start or to_clear:
+            session_state.update(to_start)
+            for session_id in to_clear:
+                state_pop(session_id, None)
+            self._state_dirty = True
+
+        terminated = self.terminate_sessions(to_kill)
+        if terminated:
+            # Remove from state
+            for session_id in terminated:
+                state_pop(session_id, None)
+            self._state_dirty = True
+
+        # Save updated session state, skipping the write when nothing changed
+        self.flush()
+        return len(terminated)
 
 
 def main():
@@ -172,6 +322,7 @@ def main():
     parser.add_argument('--verbose', '-v', action='store_true', help='Enable verbose logging')
     parser.add_argument('--debug', '-d', action='store_true', help='Enable debug logging (very verbose)')
     parser.add_argument('--state-file', help='Path to file for storing session state between runs')
+    parser.add_argument('--interval', type=int, default=0, help='Run continuously, checking sessions every N seconds (default: 0, run once and exit)')
     
     args = parser.parse_args()
     
@@ -188,17 +339,41 @@ def main():
         state_file=args.state_file
     )
     
-    logger.info(f"Starting Jellyfin session terminator")
-    logger.info(f"Server: {args.server}")
-    logger.info(f"Timeout: {args.timeout} minutes")
+    logger.info("Starting Jellyfin session terminator")
+    logger.info("Server: %s", args.server)
+    logger.info("Timeout: %s minutes", args.timeout)
     # Removed the dry run status log
     
-    terminated = terminator.process_sessions()
+    def log_result(terminated):
+        if args.dry_run:
+            logger.info("Dry run completed. Would have terminated %s session(s).", terminated)
+        else:
+            logger.info("Completed. Terminated %s session(s).", terminated)
+    
+    if args.interval <= 0:
+        try:
+            log_result(terminator.process_sessions())
+        finally:
+            terminator.close()
+        return
     
-    if args.dry_run:
-        logger.info(f"Dry run completed. Would have terminated {terminated} session(s).")
-    else:
-        logger.info(f"Completed. Terminated {terminated} session(s).")
+    # Daemon mode: keep one terminator (and its keep-alive connection) across every check
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    logger.info("Checking sessions every %s seconds", args.interval)
+    try:
+        while True:
+            try:
+                log_result(terminator.process_sessions())
+            except Exception:
+                # Keep the daemon alive; the next check retries just as a cron run would
+                logger.exception("Error processing sessions")
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        terminator.flush()
+        terminator.close()
+        logger.info("Stopped Jellyfin session terminator")
 
 if __name__ == "__main__":
     main()
@@ -16,3 +16,7 @@ python3 $SCRIPT_PATH --server $JELLYFIN_SERVER --api-key $API_KEY --timeout $TIM
 # crontab -e
 # Then add a line like:
 # */5 * * * * /path/to/cron_script.sh >> /var/log/jellyfin-session-terminator.log 2>&1
+#
+# Alternatively, skip cron and run the script as a long-lived service (e.g. a systemd unit)
+# by adding --interval SECONDS, which checks sessions on that interval and reuses one connection:
+# python3 $SCRIPT_PATH --server $JELLYFIN_SERVER --api-key $API_KEY --timeout $TIMEOUT_MINUTES --interval 300